@@ -1,8 +1,24 @@
 #!/usr/bin/python
 
+import json
+from concurrent.futures import ThreadPoolExecutor
 from ansible.module_utils.basic import AnsibleModule
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+
+try:
+  import ijson
+  HAS_IJSON = True
+except ImportError:
+  HAS_IJSON = False
+
+try:
+  import orjson
+  HAS_ORJSON = True
+except ImportError:
+  HAS_ORJSON = False
 
 # Copyright: (c) 2020, Sebastian Sdorra <s.sdorra@gmail.com>
 # MIT License (see https://opensource.org/licenses/MIT)
@@ -100,84 +116,238 @@ msg:
   description: A message describing what happened.
   type: str
   returned: always
+errors:
+  description: The operations which failed, one entry per failure.
+  type: list
+  elements: dict
+  returned: on failure
+  contains:
+    server:
+      description: URL of the AdGuard server.
+      type: str
+    rewrite:
+      description: The rewrite which could not be applied, null for list and config errors.
+      type: dict
+    op:
+      description: The failed operation.
+      type: str
+      choices: [ 'config', 'list', 'add', 'delete' ]
+    error:
+      description: The error message.
+      type: str
 '''
 
+MAX_SERVER_WORKERS = 32
+REWRITE_WORKERS = 16
+READ_METHODS = frozenset(['GET'])
+WRITE_METHODS = frozenset(['POST'])
+# (connect, read) timeout in seconds for every request
+TIMEOUT = (5, 10)
+
+
+def _key(rewrite):
+  return (rewrite['domain'], rewrite['answer'])
+
+
+def _server_url(server):
+  return server['url'].rstrip('/')
+
+
+def _dumps(data):
+  if HAS_ORJSON:
+    return orjson.dumps(data)
+  return json.dumps(data)
+
+
+def _build_retry(methods, **options):
+  options = dict(
+    dict(
+      total=5,
+      connect=2,
+      backoff_factor=0.5,
+      respect_retry_after_header=True,
+      raise_on_status=False),
+    **options)
+  try:
+    return Retry(allowed_methods=methods, **options)
+  except TypeError:
+    # urllib3 < 1.26 only knows the old name of the option
+    return Retry(method_whitelist=methods, **options)
+
+
+def _build_read_retry():
+  return _build_retry(READ_METHODS, read=1, status_forcelist=(429, 500, 502, 503, 504))
+
+
+def _build_write_retry():
+  # Adding a rewrite is not idempotent, so a POST is only retried when the
+  # server has not processed it: connection errors, 429 and (via Retry-After)
+  # 503. Read errors and other 5xx responses may come after the change was
+  # applied and are reported instead.
+  return _build_retry(WRITE_METHODS, read=0, status_forcelist=(429,))
+
+
+def _build_session(username, password, retry):
+  session = requests.Session()
+  session.auth = HTTPBasicAuth(username, password)
+  session.headers.update({
+    'Content-Type': 'application/json'
+  })
+  adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=REWRITE_WORKERS,
+    max_retries=retry)
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+  return session
+
+
 class AdGuardClient:
   def __init__(self, url, username, password):
     self.url = url
-    self.auth = HTTPBasicAuth(username, password)
-    self.headers = {
-      'Content-Type': 'application/json'
-    }
+    self.session = _build_session(username, password, _build_read_retry())
+    self.write_session = _build_session(username, password, _build_write_retry())
+
+  def close(self):
+    self.session.close()
+    self.write_session.close()
 
   def list_rewrites(self):
-    response = requests.get(
-      f'{self.url}/control/rewrite/list', headers=self.headers, auth=self.auth)
-    if response.status_code != 200:
-      raise Exception(f"Failed to fetch rewrites: {response.text}")
-    return response.json()
+    # Returns the (domain, answer) keys of the existing rewrites. With ijson
+    # available the response is parsed while streaming, so the full list is
+    # never held in memory.
+    with self.session.get(f'{self.url}/control/rewrite/list', stream=True, timeout=TIMEOUT) as response:
+      if response.status_code != 200:
+        raise Exception(f"Failed to fetch rewrites: {response.text}")
+      if HAS_IJSON:
+        response.raw.decode_content = True
+        items = ijson.items(response.raw, 'item')
+      elif HAS_ORJSON:
+        items = orjson.loads(response.content)
+      else:
+        items = response.json()
+      return {_key(r) for r in items}
 
   def add_rewrite(self, rewrite):
-    response = requests.post(
-      f'{self.url}/control/rewrite/add', json=rewrite, headers=self.headers, auth=self.auth)
+    response = self.write_session.post(f'{self.url}/control/rewrite/add', data=_dumps(rewrite), timeout=TIMEOUT)
     if response.status_code != 200:
       raise Exception(f"Failed to add rewrite: {response.text}")
 
   def delete_rewrite(self, rewrite):
-    response = requests.post(
-      f'{self.url}/control/rewrite/delete', json=rewrite, headers=self.headers, auth=self.auth)
+    response = self.write_session.post(f'{self.url}/control/rewrite/delete', data=_dumps(rewrite), timeout=TIMEOUT)
     if response.status_code != 200:
       raise Exception(f"Failed to delete rewrite: {response.text}")
 
+  def add_rewrites(self, rewrites, executor):
+    return self._apply(self.add_rewrite, rewrites, executor)
+
+  def delete_rewrites(self, rewrites, executor):
+    return self._apply(self.delete_rewrite, rewrites, executor)
 
-def manage_rewrites(data):
-  servers = data['servers']
-  rewrites = data['rewrites']
+  def _apply(self, operation, rewrites, executor):
+    # AdGuard has no bulk endpoint, so every rewrite is still its own request,
+    # but they run in parallel on the given executor over the pooled session.
+    applied = []
+    failures = []
+    futures = [(rewrite, executor.submit(operation, rewrite)) for rewrite in rewrites]
+    for rewrite, future in futures:
+      try:
+        future.result()
+        applied.append(rewrite)
+      except Exception as e:
+        failures.append((rewrite, e))
+    return applied, failures
+
+
+def manage_rewrites(data, check_mode=False):
+  servers, conflicts = unique_servers(data['servers'])
+  if conflicts:
+    return True, False, conflicts
+  rewrites = {_key(r): r for r in data['rewrites']}
   state = data['state']
 
   changed = False
   errors = []
 
+  # Servers are handled concurrently, so every server must appear only once,
+  # otherwise two workers would race to apply the same rewrites to it.
+  # All servers share one executor for the add/delete requests, which bounds
+  # the total number of threads and of concurrent requests per server to
+  # REWRITE_WORKERS, matching the size of the connection pool.
+  workers = max(1, min(MAX_SERVER_WORKERS, len(servers)))
+  with ThreadPoolExecutor(max_workers=REWRITE_WORKERS) as rewrite_executor, \
+      ThreadPoolExecutor(max_workers=workers) as executor:
+    futures = [
+      executor.submit(handle_server, server, rewrites, state, check_mode, rewrite_executor)
+      for server in servers]
+    for future in futures:
+      server_changed, server_errors = future.result()
+      changed = changed or server_changed
+      errors.extend(server_errors)
+
+  if errors:
+    return True, changed, errors
+  return False, changed, None
+
+
+def unique_servers(servers):
+  result = {}
+  conflicts = []
   for server in servers:
-    client = AdGuardClient(
-      server['url'], server['username'], server['password'])
+    url = _server_url(server)
+    known = result.setdefault(url, server)
+    if (known['username'], known['password']) != (server['username'], server['password']):
+      conflicts.append({
+        'server': url, 'rewrite': None, 'op': 'config',
+        'error': 'Server is listed more than once with different credentials'})
+  return list(result.values()), conflicts
+
+
+def handle_server(server, rewrites, state, check_mode, executor):
+  changed = False
+  errors = []
+
+  url = _server_url(server)
+  client = AdGuardClient(url, server['username'], server['password'])
+  try:
     try:
-      current_rewrites = client.list_rewrites()
+      current_set = client.list_rewrites()
     except Exception as e:
-      errors.append(f"Error listing rewrites for server {server['url']}: {str(e)}")
-      continue
+      errors.append({'server': url, 'rewrite': None, 'op': 'list', 'error': str(e)})
+      return changed, errors
 
     if state == 'present':
       changed, errors = handle_present_state(
-        client, rewrites, current_rewrites, changed, errors, server['url'])
+        client, rewrites, current_set, changed, errors, url, check_mode, executor)
     elif state == 'absent':
       changed, errors = handle_absent_state(
-        client, rewrites, current_rewrites, changed, errors, server['url'])
-
-  if errors:
-    return True, changed, errors
-  return False, changed, None
+        client, rewrites, current_set, changed, errors, url, check_mode, executor)
+    return changed, errors
+  finally:
+    client.close()
 
 
-def handle_present_state(client, rewrites, current_rewrites, changed, errors, server_url):
-  for rewrite in rewrites:
-    if rewrite not in current_rewrites:
-      try:
-        client.add_rewrite(rewrite)
-        changed = True
-      except Exception as e:
-        errors.append(f"Error adding rewrite {rewrite} to server {server_url}: {str(e)}")
+def handle_present_state(client, rewrites, current_set, changed, errors, server_url, check_mode, executor):
+  to_add = [r for key, r in rewrites.items() if key not in current_set]
+  if check_mode:
+    return changed or bool(to_add), errors
+  applied, failures = client.add_rewrites(to_add, executor)
+  if applied:
+    changed = True
+  for rewrite, e in failures:
+    errors.append({'server': server_url, 'rewrite': rewrite, 'op': 'add', 'error': str(e)})
   return changed, errors
 
 
-def handle_absent_state(client, rewrites, current_rewrites, changed, errors, server_url):
-  for rewrite in rewrites:
-    if rewrite in current_rewrites:
-      try:
-        client.delete_rewrite(rewrite)
-        changed = True
-      except Exception as e:
-        errors.append(f"Error deleting rewrite {rewrite} from server {server_url}: {str(e)}")
+def handle_absent_state(client, rewrites, current_set, changed, errors, server_url, check_mode, executor):
+  to_delete = [r for key, r in rewrites.items() if key in current_set]
+  if check_mode:
+    return changed or bool(to_delete), errors
+  applied, failures = client.delete_rewrites(to_delete, executor)
+  if applied:
+    changed = True
+  for rewrite, e in failures:
+    errors.append({'server': server_url, 'rewrite': rewrite, 'op': 'delete', 'error': str(e)})
   return changed, errors
 
 
@@ -188,7 +358,10 @@ def main():
       username=dict(type='str', required=True),
       password=dict(type='str', required=True, no_log=True),
     )),
-    rewrites=dict(type='list', elements='dict', required=True),
+    rewrites=dict(type='list', elements='dict', required=True, options=dict(
+      domain=dict(type='str', required=True),
+      answer=dict(type='str', required=True),
+    )),
     state=dict(type='str', choices=[
          'present', 'absent'], default='present')
   )
@@ -198,7 +371,7 @@ def main():
     supports_check_mode=True
   )
 
-  is_error, has_changed, errors = manage_rewrites(module.params)
+  is_error, has_changed, errors = manage_rewrites(module.params, module.check_mode)
 
   if is_error:
     module.fail_json(msg="Error managing rewrites", errors=errors)